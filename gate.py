@@ -1,46 +1,137 @@
 #!/usr/bin/env python3
 import time
-import json
+import random
+import orjson
+import threading
+import socket
+import selectors
+from concurrent.futures import ThreadPoolExecutor
 import RPi.GPIO as GPIO
 import board
 import neopixel
 from mfrc522 import SimpleMFRC522
 import paho.mqtt.client as mqtt
+from paho.mqtt.properties import Properties
+from paho.mqtt.packettypes import PacketTypes
 from dotenv import load_dotenv
 import os
 
 # OLED Imports
+import numpy as np
 from PIL import Image, ImageDraw, ImageFont
 import lib.oled.SSD1331 as SSD1331
 
 # Hardware Config
 from config import *
 
+# MFRC522 IRQ line wired to a spare GPIO (BCM)
+MFRC_IRQ_PIN = 24
+# How often a fresh REQA is sent while waiting for a card (seconds)
+RFID_ARM_PERIOD = 0.15
+
+# Backoff between MQTT reconnect attempts (seconds)
+MQTT_RECONNECT_MIN = 1
+MQTT_RECONNECT_MAX = 30
+
+# How long a decision stays on screen (seconds)
+RESULT_HOLD = 3.0
+
+# Same card is ignored for this long after its result screen ends (seconds)
+REREAD_DEBOUNCE = 1.0
+
+# Strip colors used by the gate: off, direction prompt, waiting, granted, denied
+LED_COLORS = ((0, 0, 0), (0, 0, 50), (50, 50, 0), (0, 255, 0), (255, 0, 0))
+
+# OLED SPI clock used for full-frame writes
+OLED_SPI_HZ = 8_000_000
+
+# Denial reasons that have a pre-rendered screen
+RESULT_SCREENS = {
+    "BANNED": "banned",
+    "DIRECTION_ERROR": "dir_err",
+    "UNKNOWN": "denied",
+    "Timeout": "timeout",
+}
+
 class AccessGate:
     def __init__(self):
         self.running = True
-        self.last_rfid = None
-        self.waiting_for_server = False
+        self.last_rfid = (None, 0.0) # (uid, monotonic time of its last decision)
+        self._response_event = threading.Event()
+        self._response_payload = None
+        self._req_id = random.getrandbits(32) # Unique per run, so replies to a previous run never match
+        self._direction = None
+        self._direction_event = threading.Event()
+        self._idle_at = None # monotonic time to restore the idle screen, None when idle
+        self._card_irq = False
+
+        # --- Event Loop (MQTT socket + GPIO wakeups, all on the main thread) ---
+        self._sel = selectors.DefaultSelector()
+        self._wake_r, self._wake_w = socket.socketpair()
+        self._wake_r.setblocking(False)
+        self._wake_w.setblocking(False)
+        self._sel.register(self._wake_r, selectors.EVENT_READ, "gpio")
+        self._mqtt_sock = None
+        self._reconnect_at = 0.0
+        self._reconnect_delay = MQTT_RECONNECT_MIN
         
         # --- Hardware Setup ---
         self._setup_gpio()
         self._setup_oled()
         self._setup_ws2812()
         self.rfid_reader = SimpleMFRC522()
+        self._setup_rfid_irq()
         
         # --- MQTT Setup ---
-        self.mqtt_client = mqtt.Client()
-        self.mqtt_client.on_connect = self._on_mqtt_connect
-        self.mqtt_client.on_message = self._on_mqtt_message
-
         load_dotenv()
         self.gate_id = os.getenv("GATE_ID")
         self.mqtt_broker = os.getenv("MQTT_BROKER")
         self.topic_request = os.getenv("TOPIC_REQUEST")
         self.topic_response = os.getenv("TOPIC_RESPONSE")
 
+        self.mqtt_client = mqtt.Client(client_id=self.gate_id, protocol=mqtt.MQTTv5, transport="tcp")
+        self.mqtt_client.max_inflight_messages_set(50)
+        self.mqtt_client.max_queued_messages_set(0) # Unlimited, never drop or stall
+        self.mqtt_client.on_connect = self._on_mqtt_connect
+        self.mqtt_client.on_message = self._on_mqtt_message
+
     def _setup_gpio(self):
         self.buzzer_pwm = GPIO.PWM(buzzerPin, 1000) # Initial 1kHz
+        self._fx = ThreadPoolExecutor(max_workers=1) # Melodies play here, one at a time
+
+        # Buttons are active low, presses are delivered as edge interrupts
+        GPIO.setup(buttonGreen, GPIO.IN, pull_up_down=GPIO.PUD_UP)
+        GPIO.setup(buttonRed, GPIO.IN, pull_up_down=GPIO.PUD_UP)
+        GPIO.add_event_detect(buttonGreen, GPIO.FALLING, callback=self._on_green, bouncetime=200)
+        GPIO.add_event_detect(buttonRed, GPIO.FALLING, callback=self._on_red, bouncetime=200)
+
+    def _setup_rfid_irq(self):
+        GPIO.setup(MFRC_IRQ_PIN, GPIO.IN, pull_up_down=GPIO.PUD_UP)
+        GPIO.add_event_detect(MFRC_IRQ_PIN, GPIO.FALLING, callback=self._on_rfid_irq)
+
+    def _arm_rfid_irq(self):
+        """Clears pending interrupts and sends a single REQA so a card in range triggers the IRQ."""
+        reader = self.rfid_reader.READER
+        # Clear flags left by the previous read first, or enabling RxIRq pulls the line low
+        reader.Write_MFRC522(reader.CommIrqReg, 0x7F)
+        # Raise IRQ (active low) only on "RX complete", i.e. when a card answers.
+        # Every read rewrites CommIEnReg, so this has to be restored before each REQA.
+        reader.Write_MFRC522(reader.CommIEnReg, 0xA0)
+        reader.Write_MFRC522(reader.DivlEnReg, 0x00)
+        reader.Write_MFRC522(reader.FIFOLevelReg, 0x80) # Flush FIFO
+        reader.Write_MFRC522(reader.FIFODataReg, reader.PICC_REQIDL)
+        reader.Write_MFRC522(reader.CommandReg, reader.PCD_TRANSCEIVE)
+        reader.Write_MFRC522(reader.BitFramingReg, 0x87) # StartSend, 7-bit frame
+
+    def _read_card_id(self):
+        """Returns the UID of the card that answered the last REQA, or None."""
+        # The card is already READY, a second REQA (as in read_no_block) would send
+        # it back to IDLE, so continue straight from anticollision
+        reader = self.rfid_reader.READER
+        status, uid = reader.MFRC522_Anticoll()
+        if status != reader.MI_OK:
+            return None
+        return self.rfid_reader.uid_to_num(uid)
 
     def _setup_oled(self):
         self.disp = SSD1331.SSD1331()
@@ -48,21 +139,53 @@ class AccessGate:
         self.disp.clear()
         self.font_large = ImageFont.truetype('./lib/oled/Font.ttf', 20)
         self.font_small = ImageFont.truetype('./lib/oled/Font.ttf', 13)
+        SSD1331.config.spi.max_speed_hz = OLED_SPI_HZ
+
+        # One framebuffer reused for every render
+        self._img = Image.new("RGB", (self.disp.width, self.disp.height), "BLACK")
+        self._draw = ImageDraw.Draw(self._img)
+        self._frame_cache = {}  # (line1, line2, color) -> packed RGB565 frame
+        self._last_key = None
+
+        # Fixed screens are rendered and packed once, showing them is a plain blit
+        self._screens = {
+            "idle": self._render("Gate Ready", "Place Card..."),
+            "select": self._render("Select Mode:", "Grn:IN | Red:OUT"),
+            "verify": self._render("Verifying...", "Please wait"),
+            "granted": self._render("ACCESS GRANTED", "Welcome!"),
+            "banned": self._render("USER BANNED", "BANNED"),
+            "dir_err": self._render("ALREADY IN/OUT", "DIRECTION_ERROR"),
+            "denied": self._render("ACCESS DENIED", "UNKNOWN"),
+            "timeout": self._render("ACCESS DENIED", "Timeout"),
+        }
 
     def _setup_ws2812(self):
         # Initialize NeoPixels on GPIO 18
         self.pixels = neopixel.NeoPixel(board.D18, 8, brightness=0.1, auto_write=False)
+
+        # Encode every used color once, switching colors then only transmits the buffer
+        self._led_frames = {}
+        for color in LED_COLORS:
+            self.pixels.fill(color)
+            self._led_frames[color] = bytearray(self.pixels._post_brightness_buffer)
         self.set_led_strip((0, 0, 0)) # Off
 
     # --- Feedback Methods ---
     
     def set_led_strip(self, color):
         """Sets the entire WS2812 strip to a color (R, G, B)."""
-        self.pixels.fill(color)
-        self.pixels.show()
+        frame = self._led_frames.get(color)
+        if frame is None:
+            self.pixels.fill(color)
+            self.pixels.show()
+        else:
+            self.pixels._transmit(frame)
 
     def play_tone(self, tone_type):
-        """Plays a melody based on type: 'success', 'error', 'click'."""
+        """Plays a melody based on type: 'success', 'error', 'click' without blocking."""
+        self._fx.submit(self._play_tone_blocking, tone_type)
+
+    def _play_tone_blocking(self, tone_type):
         if tone_type == "click":
             self.buzzer_pwm.start(50)
             self.buzzer_pwm.ChangeFrequency(2000)
@@ -85,37 +208,66 @@ class AccessGate:
             time.sleep(0.3)
             self.buzzer_pwm.stop()
 
+    @staticmethod
+    def _to_rgb565(image):
+        """Packs an RGB image into big-endian RGB565 bytes as expected by the SSD1331."""
+        a = np.asarray(image, dtype=np.uint16)
+        rgb565 = ((a[..., 0] >> 3) << 11) | ((a[..., 1] >> 2) << 5) | (a[..., 2] >> 3)
+        return rgb565.astype(">u2").tobytes()
+
+    def _render(self, line1, line2="", color="WHITE"):
+        """Renders two lines of text into a packed frame."""
+        self._draw.rectangle((0, 0, self.disp.width, self.disp.height), fill="BLACK")
+        self._draw.text((0, 5), line1, font=self.font_small, fill=color)
+        self._draw.text((0, 30), line2, font=self.font_small, fill=color)
+        return self._to_rgb565(self._img)
+
+    def _blit(self, frame):
+        """Writes a packed frame to the whole screen in one SPI transfer."""
+        self.disp.SetWindows(0, 0, self.disp.width, self.disp.height)
+        SSD1331.config.digital_write(self.disp.DC_PIN, GPIO.HIGH)
+        SSD1331.config.spi.writebytes2(frame)
+
+    def show_screen(self, name):
+        """Shows one of the pre-rendered fixed screens."""
+        if name == self._last_key:
+            return
+        self._blit(self._screens[name])
+        self._last_key = name
+
     def update_display(self, line1, line2="", color="WHITE"):
-        """Draws text on the OLED screen."""
-        image = Image.new("RGB", (self.disp.width, self.disp.height), "BLACK")
-        draw = ImageDraw.Draw(image)
-        draw.text((0, 5), line1, font=self.font_small, fill=color)
-        draw.text((0, 30), line2, font=self.font_small, fill=color)
-        self.disp.ShowImage(image, 0, 0)
+        """Draws dynamic text on the OLED screen, skipping redraws of the current frame."""
+        key = (line1, line2, color)
+        if key == self._last_key:
+            return
+
+        frame = self._frame_cache.get(key)
+        if frame is None:
+            frame = self._render(line1, line2, color)
+            self._frame_cache[key] = frame
+
+        self._blit(frame)
+        self._last_key = key
 
     # --- Core Logic ---
     def wait_for_direction(self):
         """Waits for Green (IN) or Red (OUT) button press."""
-        self.update_display("Select Mode:", "Grn:IN | Red:OUT")
+        self.show_screen("select")
         self.play_tone("click")
         
         # Blue indication on LEDs
         self.set_led_strip((0, 0, 50)) 
 
-        while True:
-            if GPIO.input(buttonGreen) == 0: # Pressed (Low)
-                self.play_tone("click")
-                return "in"
-            if GPIO.input(buttonRed) == 0: # Pressed (Low)
-                self.play_tone("click")
-                return "out"
-            
-            time.sleep(0.05)
+        # Ignore presses that happened before the prompt
+        self._direction_event.clear()
+        while not self._direction_event.is_set():
+            self._poll(1.0)
+        self.play_tone("click")
+        return self._direction
 
     def process_access(self, rfid_id, direction):
         """Sends request to server and handles response."""
-        self.waiting_for_server = True
-        self.update_display("Verifying...", "Please wait")
+        self.show_screen("verify")
         self.set_led_strip((50, 50, 0)) # Yellow wait
 
         payload = {
@@ -123,15 +275,24 @@ class AccessGate:
             "gate_id": self.gate_id,
             "direction": direction
         }
-        self.mqtt_client.publish(self.topic_request, json.dumps(payload))
+        self._req_id += 1
+        payload["req_id"] = self._req_id
+        self._response_payload = None
+        self._response_event.clear()
+        self.mqtt_client.publish(self.topic_request, orjson.dumps(payload), qos=0, retain=False)
 
-        # Wait for response (handled in _on_mqtt_message)
-        timeout = 0
-        while self.waiting_for_server and timeout < 50: # 5 seconds timeout
-            time.sleep(0.1)
-            timeout += 1
-        
-        if self.waiting_for_server:
+        # Wait for response (set in _on_mqtt_message)
+        deadline = time.monotonic() + 5.0
+        while not self._response_event.is_set():
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            self._poll(remaining)
+
+        if self._response_event.is_set():
+            response = self._response_payload
+            self.handle_result(response.get("status"), response.get("reason", ""))
+        else:
             # Timeout happened
             self.handle_result("ERROR", "Timeout")
 
@@ -140,34 +301,112 @@ class AccessGate:
         print(f"[LOGIC] Result: {status} ({reason})")
         
         if status == "GRANTED":
-            self.update_display("ACCESS GRANTED", "Welcome!")
+            self.show_screen("granted")
             self.set_led_strip((0, 255, 0)) # Green
             self.play_tone("success")
         else:
-            # Error or Denied
-            if reason == "BANNED":
-                msg = "USER BANNED"
-            elif reason == "DIRECTION_ERROR":
-                msg = "ALREADY IN/OUT"
+            # Error or Denied, unexpected reasons go through the slow path
+            if reason in RESULT_SCREENS:
+                self.show_screen(RESULT_SCREENS[reason])
             else:
-                msg = "ACCESS DENIED"
-            
-            self.update_display(msg, reason)
+                self.update_display("ACCESS DENIED", reason)
             self.set_led_strip((255, 0, 0)) # Red
             self.play_tone("error")
 
-        time.sleep(3) # Show result for 3 seconds
-        self.waiting_for_server = False
+        # Show result for 3 seconds, the main loop restores idle afterwards
+        self._idle_at = time.monotonic() + RESULT_HOLD
+
+    def _return_to_idle(self):
+        self._idle_at = None
+        self.show_screen("idle")
+        self.set_led_strip((0, 0, 0)) # Off or faint white
+
+    # --- Event Loop ---
+
+    def _wake(self):
+        # Interrupt a pending select() from a GPIO callback thread
+        try:
+            self._wake_w.send(b"\0")
+        except BlockingIOError:
+            pass
+
+    def _reconnect(self):
+        # Retry with backoff so a dead broker doesn't block the main loop on every poll
+        now = time.monotonic()
+        if now < self._reconnect_at:
+            return
+        try:
+            self.mqtt_client.reconnect()
+        except OSError as e:
+            print(f"[MQTT] Reconnect failed, retrying in {self._reconnect_delay}s: {e}")
+            self._reconnect_at = now + self._reconnect_delay
+            self._reconnect_delay = min(self._reconnect_delay * 2, MQTT_RECONNECT_MAX)
+
+    def _poll(self, timeout):
+        """Waits up to timeout for MQTT traffic or a GPIO event and services it inline."""
+        if self.mqtt_client.socket() is None:
+            self._reconnect()
+
+        sock = self.mqtt_client.socket()
+        if sock is not self._mqtt_sock:
+            if self._mqtt_sock is not None:
+                self._sel.unregister(self._mqtt_sock)
+            if sock is not None:
+                self._sel.register(sock, selectors.EVENT_READ, "mqtt")
+            self._mqtt_sock = sock
+
+        # While disconnected only the GPIO wakeups are watched
+        if sock is not None:
+            events = selectors.EVENT_READ
+            if self.mqtt_client.want_write():
+                events |= selectors.EVENT_WRITE
+            self._sel.modify(sock, events, "mqtt")
+
+        for key, mask in self._sel.select(timeout):
+            if key.data == "mqtt":
+                if mask & selectors.EVENT_READ:
+                    self.mqtt_client.loop_read()
+                if mask & selectors.EVENT_WRITE:
+                    self.mqtt_client.loop_write()
+            else:
+                try:
+                    while self._wake_r.recv(64):
+                        pass
+                except BlockingIOError:
+                    pass
+
+        if sock is not None:
+            self.mqtt_client.loop_misc() # Keepalive pings
+
+    # --- GPIO Callbacks ---
+
+    def _on_green(self, channel):
+        self._direction = "in"
+        self._direction_event.set()
+        self._wake()
+
+    def _on_red(self, channel):
+        self._direction = "out"
+        self._direction_event.set()
+        self._wake()
+
+    def _on_rfid_irq(self, channel):
+        self._card_irq = True
+        self._wake()
 
     # --- MQTT Callbacks ---
 
-    def _on_mqtt_connect(self, client, userdata, flags, rc):
+    def _on_mqtt_connect(self, client, userdata, flags, rc, properties=None):
         print(f"[MQTT] Connected with code {rc}")
+        if rc == 0:
+            self._reconnect_delay = MQTT_RECONNECT_MIN
+        # Disable Nagle so small requests go out immediately
+        client.socket().setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
         client.subscribe(self.topic_response)
 
     def _on_mqtt_message(self, client, userdata, msg):
         try:
-            payload = json.loads(msg.payload.decode())
+            payload = orjson.loads(msg.payload)
             resp_gate = payload.get("gate_id")
             # Ignore responses intended for other gates
             if resp_gate is None:
@@ -176,9 +415,14 @@ class AccessGate:
             if resp_gate != self.gate_id:
                 print(f"[MQTT] Ignored message for gate {resp_gate}")
                 return
+            # Ignore late or duplicate responses to earlier requests
+            if payload.get("req_id") != self._req_id:
+                print(f"[MQTT] Ignored stale response {payload.get('req_id')}")
+                return
 
-            if self.waiting_for_server:
-                self.handle_result(payload.get("status"), payload.get("reason", ""))
+            # Hand the response over to process_access
+            self._response_payload = payload
+            self._response_event.set()
         except Exception as e:
             print(f"[MQTT] Error processing message: {e}")
 
@@ -186,21 +430,40 @@ class AccessGate:
 
     def start(self):
         try:
-            self.mqtt_client.connect(self.mqtt_broker, 1883, 60)
-            self.mqtt_client.loop_start() # Run MQTT in background thread
+            # Announce the largest receive window, only QoS 1/2 flows count against it
+            properties = Properties(PacketTypes.CONNECT)
+            properties.ReceiveMaximum = 65535
+            self.mqtt_client.connect(self.mqtt_broker, 1883, 60, clean_start=True, properties=properties)
+            # MQTT is serviced inline by _poll, no network thread
 
             print("[GATE] System Ready.")
+
+            self._return_to_idle()
             
             while self.running:
-                # 1. Idle State
-                self.update_display("Gate Ready", "Place Card...")
-                self.set_led_strip((0, 0, 0)) # Off or faint white
-                
-                # 2. Read RFID
+                # 1. Idle State (restored once the result has been shown long enough)
+                if self._idle_at is not None and time.monotonic() >= self._idle_at:
+                    self._return_to_idle()
+
+                # 2. Read RFID (sleep until the reader raises its IRQ)
                 try:
-                    rfid_id = self.rfid_reader.read_no_block()[0]
+                    self._card_irq = False
+                    self._arm_rfid_irq()
+                    self._poll(RFID_ARM_PERIOD)
+                    if not self._card_irq:
+                        continue
 
-                    if rfid_id:
+                    rfid_id = self._read_card_id()
+
+                    # Prevent re-reading the same card while its result is shown and
+                    # shortly after, other cards go through
+                    last_uid, last_time = self.last_rfid
+                    repeat = (rfid_id == last_uid and
+                              time.monotonic() - last_time < RESULT_HOLD + REREAD_DEBOUNCE)
+
+                    if rfid_id and not repeat:
+                        # A new card cuts the previous result screen short
+                        self._idle_at = None
                         print(f"[GATE] Card Detected: {rfid_id}")
                         
                         # 3. Select Direction
@@ -209,12 +472,11 @@ class AccessGate:
                         
                         # 4. Verify Access
                         self.process_access(rfid_id, direction)
-                        
-                        # Prevent immediate re-read
-                        time.sleep(1)
+                        self.last_rfid = (rfid_id, time.monotonic())
 
                 except Exception as e:
                     print(f"[GATE] Unexpected Error: {e}")
+                    self._return_to_idle()
 
                 time.sleep(0.1)
 
@@ -225,12 +487,15 @@ class AccessGate:
             self.cleanup()
 
     def cleanup(self):
+        self._fx.shutdown(wait=True)
         self.set_led_strip((0, 0, 0))
         self.disp.clear()
+        self._last_key = None
         self.disp.reset()
         self.buzzer_pwm.stop()
         GPIO.cleanup()
-        self.mqtt_client.loop_stop()
+        self.mqtt_client.disconnect()
+        self._sel.close()
 
 if __name__ == "__main__":
     gate = AccessGate()
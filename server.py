@@ -1,13 +1,43 @@
 #!/usr/bin/env python3
-import json
+import msgspec
+import socket
 import paho.mqtt.client as mqtt
-import requests
+from paho.mqtt.properties import Properties
+from paho.mqtt.packettypes import PacketTypes
+import asyncio
+import threading
+import aiohttp
 import time
 from dotenv import load_dotenv
 import os
 
 ENDPOINT_ENTRY = "/entry-access"
 
+# Convex error code -> gate command (gate_id is added per request)
+DECISION_MAP = {
+    "USER_BANNED":      {"status": "DENIED", "reason": "BANNED"},
+    "USER_ALREADY_IN":  {"status": "DENIED", "reason": "DIRECTION_ERROR"},
+    "USER_ALREADY_OUT": {"status": "DENIED", "reason": "DIRECTION_ERROR"},
+    "GATE_INACTIVE":    {"status": "ERROR", "reason": "GATE_LOCKED"},
+}
+
+# Pre-encoded fixed decisions, filled in with the JSON-encoded gate_id and req_id
+GRANTED_TPL = b'{"status":"GRANTED","message":"Access Granted","gate_id":%s,"req_id":%s}'
+DECISION_TPLS = {
+    code: msgspec.json.encode(base)[:-1] + b',"gate_id":%s,"req_id":%s}'
+    for code, base in DECISION_MAP.items()
+}
+
+class ErrorBody(msgspec.Struct):
+    code: str = "UNKNOWN"
+    message: str = "Unknown error"
+
+class ConvexResp(msgspec.Struct):
+    """Body of a Convex HTTP Action response, only the fields the server reads."""
+    error: ErrorBody = msgspec.field(default_factory=ErrorBody)
+
+_resp_decoder = msgspec.json.Decoder(ConvexResp)
+
 class Server:
 
     def __init__(self):
@@ -17,18 +47,41 @@ class Server:
         self.topic_request = os.getenv("TOPIC_REQUEST")
         self.topic_response = os.getenv("TOPIC_RESPONSE")
 
-        self.client = mqtt.Client()
+        self.client = mqtt.Client(protocol=mqtt.MQTTv5, transport="tcp")
+        self.client.max_inflight_messages_set(50)
+        self.client.max_queued_messages_set(0) # Unlimited, never drop or stall
         self.client.on_connect = self.on_connect
         self.client.on_message = self.on_message
+        self.client.on_disconnect = self.on_disconnect
+        self.client.on_connect_fail = self.on_connect_fail
+        self.client.reconnect_delay_set(min_delay=1, max_delay=30)
+        self._stop = False
 
         #-- Load API URL ---
         self.api_url = os.getenv("API_URL")
 
-    def get_access_decision(self, payload):
+        #-- Async HTTP Setup (requests from all gates run concurrently) ---
+        self.loop = asyncio.new_event_loop()
+        threading.Thread(target=self.loop.run_forever, daemon=True).start()
+        self.session = asyncio.run_coroutine_threadsafe(self._create_session(), self.loop).result()
+
+    async def _create_session(self):
+        # The session must be created on the loop it will be used from
+        connector = aiohttp.TCPConnector(limit=16)
+        return aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=5, connect=1.0))
+
+    @staticmethod
+    def _encode(decision, req_id):
+        # Echo the request id so the gate can drop stale responses
+        decision["req_id"] = req_id
+        return msgspec.json.encode(decision)
+
+    async def get_access_decision(self, payload):
         """
-        Sends request to Convex HTTP Action and maps the response to a gate command.
+        Sends request to Convex HTTP Action and maps the response to an encoded gate command.
         """
         try:
+            req_id = payload.get("req_id")
             # Determine direction string required by API ("in" | "out")
             direction = payload.get("direction", "in")
             gate_id = payload.get("gate_id")
@@ -41,78 +94,100 @@ class Server:
 
             print(f"[API] Posting to {ENDPOINT_ENTRY}: {data}")
             try:
-                response = requests.post(self.api_url + ENDPOINT_ENTRY, json=data, timeout=5)
-                status = response.status_code
-                
-                try:
-                    resp_json = response.json()
-                except json.JSONDecodeError:
-                    resp_json = {}
-                    
-            except requests.exceptions.RequestException as e:
+                async with self.session.post(self.api_url + ENDPOINT_ENTRY, data=msgspec.json.encode(data),
+                                             headers={"Content-Type": "application/json"}) as response:
+                    status = response.status
+
+                    try:
+                        resp = _resp_decoder.decode(await response.read())
+                    except msgspec.DecodeError:
+                        resp = ConvexResp()
+
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
                 print(f"[API] Network error: {e}")
-                return {"status": "ERROR", "reason": "NETWORK_FAIL", "debug": str(e), "gate_id": gate_id}
+                return self._encode({"status": "ERROR", "reason": "NETWORK_FAIL", "debug": str(e), "gate_id": gate_id}, req_id)
 
             if status == 200:
-                return {"status": "GRANTED", "message": "Access Granted", "gate_id": gate_id}
+                return GRANTED_TPL % (msgspec.json.encode(gate_id), msgspec.json.encode(req_id))
             
-            error_code = resp_json.get("error", {}).get("code", "UNKNOWN")
-            error_msg = resp_json.get("error", {}).get("message", "Unknown error")
-
-            if error_code == "USER_BANNED":
-                return {"status": "DENIED", "reason": "BANNED", "gate_id": gate_id}
-            elif error_code in ("USER_ALREADY_IN", "USER_ALREADY_OUT"):
-                return {"status": "DENIED", "reason": "DIRECTION_ERROR", "gate_id": gate_id}
-            elif error_code == "GATE_INACTIVE":
-                return {"status": "ERROR", "reason": "GATE_LOCKED", "gate_id": gate_id}
-            else:
-                return {"status": "DENIED", "reason": "UNKNOWN", "debug": error_msg, "gate_id": gate_id}
+            tpl = DECISION_TPLS.get(resp.error.code)
+            if tpl is None:
+                return self._encode({"status": "DENIED", "reason": "UNKNOWN", "debug": resp.error.message, "gate_id": gate_id}, req_id)
+            return tpl % (msgspec.json.encode(gate_id), msgspec.json.encode(req_id))
 
         except Exception as e:
             print(f"[API] Unexpected Logic Error: {e}")
             # Include gate_id if present in payload
             gate_id = payload.get("gate_id") if isinstance(payload, dict) else None
+            req_id = payload.get("req_id") if isinstance(payload, dict) else None
             resp = {"status": "ERROR", "reason": "SERVER_ERROR"}
             if gate_id:
                 resp["gate_id"] = gate_id
-            return resp
+            return self._encode(resp, req_id)
 
-    def on_connect(self, client, userdata, flags, rc):
+    def on_connect(self, client, userdata, flags, rc, properties=None):
         print(f"[MQTT] Connected to broker (Code: {rc})")
-        client.subscribe(os.getenv("TOPIC_REQUEST"))
+        # Disable Nagle so small responses go out immediately
+        client.socket().setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        # All request topics go out in a single SUBSCRIBE
+        topics = [(self.topic_request, 0)]
+        client.subscribe(topics)
         print(f"[MQTT] Listening on request...")
 
+    def on_disconnect(self, client, userdata, rc, properties=None):
+        if not self._stop:
+            print(f"[MQTT] Disconnected from broker (Code: {rc}), reconnecting...")
+
+    def on_connect_fail(self, client, userdata):
+        print(f"[MQTT] Could not connect to broker {self.mqtt_broker}, retrying...")
+
     def on_message(self, client, userdata, msg):
+        # Hand off to the asyncio loop so the paho thread is never blocked on HTTP
+        asyncio.run_coroutine_threadsafe(self._handle(client, msg), self.loop)
+
+    async def _handle(self, client, msg):
         try:
-            payload_str = msg.payload.decode("utf-8")
-            print(f"[MQTT] Received: {payload_str}")
+            print(f"[MQTT] Received: {msg.payload.decode('utf-8', 'replace')}")
             
-            request_data = json.loads(payload_str)
+            request_data = msgspec.json.decode(msg.payload)
             
             # Process logic via API
-            decision = self.get_access_decision(request_data)
+            response_payload = await self.get_access_decision(request_data)
             
             # Send response back to the specific gate
-            response_payload = json.dumps(decision)
-            client.publish(os.getenv("TOPIC_RESPONSE"), response_payload)
-            print(f"[MQTT] Sent: {response_payload}")
+            client.publish(os.getenv("TOPIC_RESPONSE"), response_payload, qos=0, retain=False)
+            print(f"[MQTT] Sent: {response_payload.decode()}")
 
-        except json.JSONDecodeError:
+        except msgspec.DecodeError:
             print("[MQTT] Error: Invalid JSON received")
         except Exception as e:
             print(f"[MQTT] Unexpected error: {e}")
 
     def start(self):
         try:
-            self.client.connect(self.mqtt_broker, 1883, 60)
-            self.client.loop_forever()
+            # Announce the largest receive window, only QoS 1/2 flows count against it
+            properties = Properties(PacketTypes.CONNECT)
+            properties.ReceiveMaximum = 65535
+            self.client.connect_async(self.mqtt_broker, 1883, 60, clean_start=True, properties=properties)
 
-            while True:
-                pass
+            # loop_forever reconnects with backoff on its own, restart it if it ever bails out
+            while not self._stop:
+                try:
+                    self.client.loop_forever(retry_first_connection=True)
+                except Exception as e:
+                    print(f"[MQTT] Network loop error: {e}")
+                    time.sleep(1)
 
         except KeyboardInterrupt:
             print("\nStopping server...")
-            self.client.disconnect()
+            self.stop()
+        finally:
+            asyncio.run_coroutine_threadsafe(self.session.close(), self.loop).result()
+            self.loop.call_soon_threadsafe(self.loop.stop)
+
+    def stop(self):
+        self._stop = True
+        self.client.disconnect()
 
 if __name__ == "__main__":
     server = Server()